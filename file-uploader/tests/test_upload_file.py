@@ -2,26 +2,68 @@
 """
 A module for testing the extractor.
 """
+import argparse
+import logging
+import os
 from pathlib import Path
+from types import SimpleNamespace
 
-from upload_file import FileWithMeta, convert_to_file_objects, match_files
+import pytest
+
+from upload_file import (
+    FileWithMeta,
+    _guess_mime_type,
+    _positive_int,
+    convert_to_file_objects,
+    filter_away_existing_files,
+    match_files,
+    process_path,
+    upload_files_to_cdf,
+)
+
+
+class FakeFilesAPI:
+    def __init__(self, external_ids, retrieve_error=None):
+        self.external_ids = external_ids
+        self.retrieve_error = retrieve_error
+        self.uploaded_ids = []
+
+    def retrieve_multiple(self, external_ids):
+        from cognite.client.exceptions import CogniteNotFoundError
+
+        if self.retrieve_error:
+            raise self.retrieve_error
+        missing = [{"externalId": i} for i in external_ids if i not in self.external_ids]
+        if missing:
+            raise CogniteNotFoundError(not_found=missing)
+        return [SimpleNamespace(external_id=i, uploaded=True) for i in external_ids]
+
+    def upload_bytes(self, content, external_id=None, **kwargs):
+        self.uploaded_ids.append(external_id)
+
+
+class FakeClient:
+    def __init__(self, external_ids, retrieve_error=None):
+        self.files = FakeFilesAPI(external_ids, retrieve_error)
 
 
 class TestExtractor:
     folder_path = Path(__file__).parent / "test-files"
 
     def test_match_files(self):
-        assert len(match_files(self.folder_path)) == 2
-        files = match_files(self.folder_path, "*.pdf")
+        assert len(list(match_files(self.folder_path))) == 2
+        files = list(match_files(self.folder_path, "*.pdf"))
         assert len(files) == 1
         assert files[0].name == "hidden.pdf"
-        assert len(match_files(self.folder_path, "*", recursive=False)) == 1
+        assert len(list(match_files(self.folder_path, "*", recursive=False))) == 1
 
     def test_convert_to_file_objects(self):
         paths = [self.folder_path / "example.txt"]
-        objects = convert_to_file_objects(self.folder_path, paths)
+        objects = list(convert_to_file_objects(self.folder_path, paths))
         assert len(objects) == 1
         assert objects[0].name == "example.txt"
+        assert objects[0].size == 0
+        assert objects[0].stat_result is objects[0].stat_result
 
     def test_convert_metadata(self):
         path = self.folder_path / "recursive" / "hidden.pdf"
@@ -29,4 +71,81 @@ class TestExtractor:
         assert obj.metadata
         assert obj.metadata["folder"] == "recursive"
         assert obj.name == "hidden.pdf"
-        assert obj.path == path
+        assert obj.path == str(path)
+        assert obj.external_id == str(Path("recursive", "hidden.pdf"))
+
+        other = FileWithMeta.from_path(self.folder_path / "recursive" / "other.txt", self.folder_path)
+        assert other.metadata is obj.metadata
+        assert obj.raw_columns() == {
+            "name": "hidden.pdf",
+            "external_id": obj.external_id,
+            "mime_type": "application/pdf",
+            "folder": "recursive",
+            "col0": "recursive",
+        }
+        assert obj.raw_columns() is obj.raw_columns()
+
+    def test_guess_mime_type(self):
+        assert _guess_mime_type(".pdf") == "application/pdf"
+        assert _guess_mime_type(".txt") == "text/plain"
+        assert _guess_mime_type(".tar.gz") == "application/x-tar"
+        assert _guess_mime_type(".tgz") == "application/x-tar"
+        assert _guess_mime_type("") is None
+
+    def test_convert_mime_type(self):
+        for name, mime_type in [
+            ("data.csv.gz", "text/csv"),
+            ("a.tar.gz", "application/x-tar"),
+            ("B.PDF", "application/pdf"),
+        ]:
+            assert FileWithMeta.from_path(self.folder_path / name, self.folder_path).mime_type == mime_type
+
+    def test_positive_int(self):
+        assert _positive_int("16") == 16
+        for value in ["0", "-1", "many"]:
+            with pytest.raises((argparse.ArgumentTypeError, ValueError)):
+                _positive_int(value)
+
+    def test_filter_away_existing_files(self):
+        objects = list(convert_to_file_objects(self.folder_path, match_files(self.folder_path)))
+        client = FakeClient(["example.txt", "unrelated.txt"])
+        remaining = list(filter_away_existing_files(client, objects))
+        assert [o.name for o in remaining] == ["hidden.pdf"]
+
+    def test_match_files_follows_file_symlinks(self, tmp_path):
+        (tmp_path / "target.txt").touch()
+        (tmp_path / "folder").mkdir()
+        (tmp_path / "folder" / "link.txt").symlink_to(tmp_path / "target.txt")
+        (tmp_path / "broken.txt").symlink_to(tmp_path / "missing.txt")
+        assert sorted(entry.name for entry in match_files(tmp_path)) == ["link.txt", "target.txt"]
+
+    @pytest.mark.skipif(os.name != "posix" or os.geteuid() == 0, reason="Needs folder permissions to apply")
+    def test_match_files_skips_unreadable_folders(self, tmp_path):
+        (tmp_path / "readable").mkdir()
+        (tmp_path / "readable" / "a.txt").touch()
+        (tmp_path / "locked").mkdir()
+        (tmp_path / "locked" / "b.txt").touch()
+        (tmp_path / "locked").chmod(0)
+        try:
+            assert [entry.name for entry in match_files(tmp_path)] == ["a.txt"]
+        finally:
+            (tmp_path / "locked").chmod(0o755)
+
+    def test_upload_files_to_cdf_skips_existing(self):
+        objects = convert_to_file_objects(self.folder_path, match_files(self.folder_path))
+        client = FakeClient(["example.txt"])
+        upload_files_to_cdf(client, objects, overwrite=False)
+        assert client.files.uploaded_ids == [str(Path("recursive", "hidden.pdf"))]
+
+    def test_upload_files_to_cdf_when_existence_check_fails(self):
+        from cognite.client.exceptions import CogniteAPIError
+
+        objects = convert_to_file_objects(self.folder_path, match_files(self.folder_path))
+        client = FakeClient(["example.txt"], retrieve_error=CogniteAPIError("External id too long", 400))
+        upload_files_to_cdf(client, objects, overwrite=False)
+        assert sorted(client.files.uploaded_ids) == ["example.txt", str(Path("recursive", "hidden.pdf"))]
+
+    def test_process_path_dry_run_logs_file_count(self, caplog):
+        with caplog.at_level(logging.INFO):
+            process_path(None, self.folder_path, upload_to_cdf=False, upload_to_raw=False)
+        assert "Found 2 files in {!s}".format(self.folder_path.resolve()) in caplog.messages
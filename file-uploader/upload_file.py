@@ -8,55 +8,109 @@ Use the command line arguments for controlling uploading of
 metadata to raw, and files to CDF.
 """
 import argparse
+import collections
+import fnmatch
+import functools
+import itertools
 import logging
 import mimetypes
 import os
+import re
 import sys
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from logging.handlers import TimedRotatingFileHandler
 from pathlib import Path
-from typing import Sequence
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
-import google.cloud.logging
-from cognite.client import CogniteClient
-from cognite.client.data_classes.raw import Row
-from cognite.client.exceptions import CogniteAPIError
+if TYPE_CHECKING:  # The Cognite SDK and Google Cloud Logging are slow to import, so they are imported when used
+    from cognite.client import CogniteClient
 
 logger = logging.getLogger(__name__)
 COGNITE_CLIENT_NAME = "cognite-file-extractor-python"
+RAW_BATCH_SIZE = 10000
+EXISTENCE_CHECK_BATCH_SIZE = 1000
+SCAN_WORKERS = 8
+
+mimetypes.init()  # Load the mime type tables up front, instead of lazily in an upload worker
+
+
+@functools.lru_cache(maxsize=1024)
+def _guess_mime_type(suffixes: str) -> Optional[str]:
+    """Guess mime type of files ending with 'suffixes', cached since a folder usually holds few distinct ones."""
+    return mimetypes.guess_type("file" + suffixes)[0]
+
+
+@functools.lru_cache(maxsize=1024)
+def _folder_metadata(folder_path: str) -> Dict[str, str]:
+    """Create metadata for files in 'folder_path', shared between all files in the folder so must not be mutated."""
+    if not folder_path:
+        return {}
+    metadata = {"folder": folder_path}
+    metadata.update({"col%s" % i: o for i, o in enumerate(folder_path.split(os.path.sep))})
+    return metadata
 
 
 class FileWithMeta:
     """A container object for all data we extract from filesystem for a single file."""
 
-    def __init__(self, path, external_id, name, mime_type=None, metadata=None):
+    __slots__ = ("path", "external_id", "name", "mime_type", "metadata", "_raw_columns", "_entry", "_stat_result")
+
+    def __init__(self, path, external_id, name, mime_type=None, metadata=None, entry=None):
         self.path = path
         self.external_id = external_id
         self.name = name
         self.mime_type = mime_type
         self.metadata = metadata
+        self._entry = entry
+        self._raw_columns = None
+        self._stat_result = None
 
     @classmethod
-    def from_path(cls, path: Path, root_path: Path):
-        external_id = str(path.relative_to(root_path))
-        mime_type = mimetypes.guess_type(path.name)[0]
+    def from_path(cls, entry: Union[os.DirEntry, Path], root_path: Union[str, Path]):
+        """Create from a file 'entry' found in 'root_path', both given as absolute paths."""
+        path = os.fspath(entry)
+        external_id = path[len(os.path.join(os.fspath(root_path), "")) :]
+        root, extension = os.path.splitext(entry.name.lower())
+        mime_type = _guess_mime_type(os.path.splitext(root)[1] + extension)  # Two suffixes, like .tar.gz
+
+        metadata = _folder_metadata(os.path.dirname(external_id) or ".")  # Same folder name as Path.parent
+        return cls(path, external_id, entry.name, mime_type, metadata=metadata, entry=entry)
+
+    @property
+    def stat_result(self) -> os.stat_result:
+        """Stat of the file, fetched on first use and then cached, reusing the scandir entry if available."""
+        if self._stat_result is None:
+            self._stat_result = (self._entry or Path(self.path)).stat()
+        return self._stat_result
+
+    @property
+    def size(self) -> int:
+        """Size of the file in bytes."""
+        return self.stat_result.st_size
+
+    @property
+    def mtime(self) -> float:
+        """Time of last modification of the file, in seconds since the epoch."""
+        return self.stat_result.st_mtime
 
-        folder_path = str(path.relative_to(root_path).parent)
-        if folder_path:
-            metadata = {"folder": folder_path}
-            metadata.update({"col%s" % i: o for i, o in enumerate(folder_path.split(os.path.sep))})
-        else:
-            metadata = {}
+    def raw_columns(self):
+        """Columns for the RAW row of this file, built once on first use so must not be mutated."""
+        if self._raw_columns is None:
+            self._raw_columns = {"name": self.name, "external_id": self.external_id}
+            if self.mime_type:
+                self._raw_columns["mime_type"] = self.mime_type
+            if self.metadata:
+                self._raw_columns.update(self.metadata)
+        return self._raw_columns
 
-        return cls(path.resolve(), external_id, path.name, mime_type, metadata=metadata)
 
-    def raw_columns(self):
-        obj = {"name": self.name, "external_id": self.external_id}
-        if self.mime_type:
-            obj["mime_type"] = self.mime_type
-        if self.metadata:
-            obj.update(self.metadata)
-        return obj
+def _positive_int(value: str) -> int:
+    """Parse 'value' as an integer of at least 1, for use as an argparse type."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("{} is not a positive integer".format(value))
+    return number
 
 
 def _parse_cli_args():
@@ -80,6 +134,13 @@ def _parse_cli_args():
     parser.add_argument(
         "--ignore-meta", required=False, action="store_true", help="Ignore metadata when uploading file"
     )
+    parser.add_argument(
+        "--max-concurrent",
+        type=_positive_int,
+        required=False,
+        default=16,
+        help="Maximum number of concurrent file uploads",
+    )
     parser.add_argument("--upload-to-raw", required=False, action="store_true", help="Upload metadata to raw")
     parser.add_argument("--raw-db", required=False, default="LandingZone", help="Which raw database")
     parser.add_argument("--raw-table", required=False, default="FileExtractor", help="Which table in raw")
@@ -100,68 +161,227 @@ def _configure_logger(folder_path: Path, log_level: str) -> None:
     )
 
     if os.environ.get("GOOGLE_APPLICATION_CREDENTIALS"):  # Temp hack
-        google.cloud.logging.Client().setup_logging(name="file-uploader-python")
-
-
-def match_files(root_path: Path, filename_pattern: str = "*", recursive: bool = True) -> Sequence[Path]:
-    """Find all files matching pattern 'filename_pattern' in 'root_path'."""
-    paths = root_path.rglob(filename_pattern) if recursive else root_path.glob(filename_pattern)
-    filtered_paths = [path for path in paths if path.is_file() and not path.name.startswith(".")]
-    logger.info("Found {} files in {!s}".format(len(filtered_paths), root_path))
-    return filtered_paths
+        import google.cloud.logging
 
+        google.cloud.logging.Client().setup_logging(name="file-uploader-python")
 
-def convert_to_file_objects(root_path: Path, paths: Sequence[Path]) -> Sequence[FileWithMeta]:
-    """Convert file 'paths' to objects with metadata."""
-    return [FileWithMeta.from_path(p, root_path) for p in paths]
 
+def _configure_http_sessions(client: "CogniteClient", pool_size: int) -> None:
+    """Let the HTTP sessions of 'client' keep at least 'pool_size' connections alive, one per concurrent request.
 
-def filter_away_existing_files(client: CogniteClient, objects: Sequence[FileWithMeta]) -> Sequence[FileWithMeta]:
-    """Remove files that are already uploaded to CDF."""
-    existing_ids = {o.external_id for o in client.files.list(uploaded=True, limit=None) if o.external_id}
-    return [o for o in objects if o.external_id and o.external_id in existing_ids]
+    The file content PUT, which the SDK does not retry itself, is retried with exponential backoff on transient
+    errors. Other requests on the same session, like creating files and inserting rows, are not idempotent and
+    only retried on connection errors, so a request the server may already have handled is never sent twice.
+    """
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
 
+    upload_retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        method_whitelist=frozenset(["PUT"]),
+        raise_on_status=True,  # The SDK does not check the status of the PUT, so fail loudly when retries run out
+    )
+    sessions = [
+        (client.files._request_session, upload_retry),
+        (client.files._request_session_with_retry, None),  # Keep the retry policy of the SDK
+    ]
+    for session, retry in sessions:
+        for prefix, adapter in list(session.adapters.items()):
+            pool_maxsize = max(pool_size, adapter._pool_maxsize)  # Never shrink the pools the SDK shares
+            session.mount(prefix, HTTPAdapter(pool_maxsize=pool_maxsize, max_retries=retry or adapter.max_retries))
+
+
+def _list_folder(folder_path: Union[str, Path]) -> Tuple[List[os.DirEntry], List[str]]:
+    """List the non-hidden files and folders directly in 'folder_path', using the file types cached by scandir."""
+    files, folders = [], []
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if entry.name[:1] == ".":
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry.path)
+            elif entry.is_file():  # Follows symlinks to files, only costing a stat for the symlinks themselves
+                files.append(entry)
+    return files, folders
+
+
+def _list_subfolder(folder_path: str) -> Tuple[List[os.DirEntry], List[str]]:
+    """List 'folder_path' like '_list_folder', but skip it with a warning if it cannot be read."""
+    try:
+        return _list_folder(folder_path)
+    except OSError as exc:
+        logger.warning("Skipping folder {}: {!s}".format(folder_path, exc))
+        return [], []
+
+
+def _scan_files(
+    folder_path: Union[str, Path], recursive: bool = True, max_workers: int = SCAN_WORKERS
+) -> Iterator[os.DirEntry]:
+    """Yield all non-hidden files in 'folder_path', listing up to 'max_workers' folders concurrently.
+
+    Hidden folders are skipped entirely, without scanning their contents, as are subfolders that cannot be read.
+    Files of one folder are yielded together, but folders come in the order their listings complete.
+    """
+    if not recursive:
+        yield from _list_folder(folder_path)[0]
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(_list_folder, folder_path)}
+        queued_folders = collections.deque()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, folders = future.result()
+                queued_folders.extend(folders)
+                while queued_folders and len(pending) < 2 * max_workers:
+                    pending.add(executor.submit(_list_subfolder, queued_folders.popleft()))
+                yield from files
+
+
+def match_files(root_path: Path, filename_pattern: str = "*", recursive: bool = True) -> Iterator[os.DirEntry]:
+    """Lazily find all files matching pattern 'filename_pattern' in 'root_path'."""
+    if filename_pattern == "*":
+        is_match = bool  # Any non-empty file name matches
+    else:
+        is_match = re.compile(fnmatch.translate(filename_pattern)).match
+
+    file_count = 0
+    for entry in _scan_files(root_path, recursive):
+        if is_match(entry.name):
+            file_count += 1
+            yield entry
+    logger.info("Found {} files in {!s}".format(file_count, root_path))
+
+
+def convert_to_file_objects(root_path: Path, paths: Iterable[Union[os.DirEntry, Path]]) -> Iterator[FileWithMeta]:
+    """Lazily convert file 'paths' to objects with metadata."""
+    return (FileWithMeta.from_path(p, root_path) for p in paths)
+
+
+def _find_existing_external_ids(
+    client: "CogniteClient", external_ids: List[str], uploaded: Optional[bool] = True
+) -> Set[str]:
+    """Find which of 'external_ids' exist in CDF, only counting files with content if 'uploaded' is set."""
+    from cognite.client.exceptions import CogniteNotFoundError
 
-def upload_metadata_to_raw(client: CogniteClient, objects: Sequence[FileWithMeta], database: str, table: str):
-    """Upload metadata of file 'objects' to CDF RAW."""
-    rows = [Row(obj.external_id, obj.raw_columns()) for obj in objects]
+    try:
+        files = client.files.retrieve_multiple(external_ids=external_ids)
+    except CogniteNotFoundError as exc:
+        missing_ids = {item.get("externalId") for item in exc.not_found}
+        existing_ids = [external_id for external_id in external_ids if external_id not in missing_ids]
+        if uploaded is None or not existing_ids:
+            return set(existing_ids)
+        files = client.files.retrieve_multiple(external_ids=existing_ids)
+    return {f.external_id for f in files if uploaded is None or f.uploaded == uploaded}
+
+
+def filter_away_existing_files(
+    client: "CogniteClient", objects: Iterable[FileWithMeta], uploaded: Optional[bool] = True
+) -> Iterator[FileWithMeta]:
+    """Remove files that already exist in CDF, only counting files with content if 'uploaded' is set.
+
+    Existence is checked with a request per batch of files, so 'objects' is still consumed lazily.
+    If the check fails, none of the files in that batch are removed.
+    """
+    from cognite.client.exceptions import CogniteAPIError, CogniteNotFoundError
+
+    objects = iter(objects)
+    for batch in iter(lambda: list(itertools.islice(objects, EXISTENCE_CHECK_BATCH_SIZE)), []):
+        try:
+            existing_ids = _find_existing_external_ids(client, [o.external_id for o in batch], uploaded)
+        except (CogniteAPIError, CogniteNotFoundError) as exc:
+            logger.warning("Failed to check for existing files in CDF, keeping the whole batch: {!s}".format(exc))
+            existing_ids = set()
+        yield from (o for o in batch if o.external_id not in existing_ids)
+
+
+def upload_metadata_to_raw(
+    client: "CogniteClient",
+    objects: Iterable[FileWithMeta],
+    database: str,
+    table: str,
+    batch_size: int = RAW_BATCH_SIZE,
+):
+    """Upload metadata of file 'objects' to CDF RAW, in batches of at most 'batch_size' rows."""
+    from cognite.client.data_classes.raw import Row
+
+    rows = (Row(obj.external_id, obj.raw_columns()) for obj in objects)
+    row_count = 0
     start_time = time.time()
-    client.raw.rows.insert(database, table, rows, ensure_parent=True)
+    for batch in iter(lambda: list(itertools.islice(rows, batch_size)), []):
+        client.raw.rows.insert(database, table, batch, ensure_parent=True)
+        row_count += len(batch)
     logger.info(
-        "Uploaded {} rows to raw:{}:{} in {:.2f} seconds".format(len(rows), database, table, time.time() - start_time)
+        "Uploaded {} rows to raw:{}:{} in {:.2f} seconds".format(row_count, database, table, time.time() - start_time)
     )
 
 
-def upload_files_to_cdf(
-    client: CogniteClient, objects: Sequence[FileWithMeta], overwrite: bool = True, ignore_meta: bool = False
+def _upload_file(
+    client: "CogniteClient", obj: FileWithMeta, file_index: int, overwrite: bool = True, ignore_meta: bool = False
 ) -> None:
-    """Upload the file 'objects' to CDF Clean."""
-    for i, obj in enumerate(objects):
-        file_index = "[{}:{}]".format(i, len(objects) - 1)
-        logger.debug("{} Starting upload of {}".format(file_index, obj.path))
-        start_time = time.time()
-        try:
-            res = client.files.upload(
-                obj.path,
+    """Upload a single file 'obj' to CDF Clean."""
+    from cognite.client.exceptions import CogniteAPIError
+    from requests.exceptions import RequestException
+
+    logger.debug("[%d] Starting upload of %s", file_index, obj.path)
+    start_time = time.monotonic()
+    try:
+        with open(obj.path, "rb") as file_handle:  # We already know it is a file, skip the SDK's own checks
+            res = client.files.upload_bytes(
+                file_handle,
                 name=obj.name,
                 external_id=obj.external_id,
                 mime_type=obj.mime_type,
                 metadata=obj.metadata if not ignore_meta else None,
                 overwrite=overwrite,
             )
-        except CogniteAPIError as exc:
-            logger.error("Failed to upload {}: {!s}".format(obj.external_id, exc))
-        else:
-            logger.info(
-                "{} Finished upload of {} in {:.2f} seconds".format(
-                    file_index, obj.external_id, time.time() - start_time
-                )
-            )
-            logger.debug("{} {!s}".format(file_index, res))
+    except (CogniteAPIError, RequestException) as exc:
+        logger.error("Failed to upload %s: %s", obj.external_id, exc)
+    else:
+        logger.info(
+            "[%d] Finished upload of %s in %.2f seconds", file_index, obj.external_id, time.monotonic() - start_time
+        )
+        logger.debug("[%d] %s", file_index, res)
+
+
+def upload_files_to_cdf(
+    client: "CogniteClient",
+    objects: Iterable[FileWithMeta],
+    overwrite: bool = True,
+    ignore_meta: bool = False,
+    max_concurrent: int = 16,
+    skip_existing: bool = True,
+) -> None:
+    """Upload the file 'objects' to CDF Clean, with at most 'max_concurrent' uploads in flight.
+
+    Only a bounded number of uploads are queued at a time, so 'objects' is consumed lazily.
+    Unless 'overwrite' is set, files already in CDF are skipped instead of being rejected after upload.
+    Pass 'skip_existing=False' when 'objects' have already been filtered against CDF.
+    """
+    if not overwrite and skip_existing:
+        objects = filter_away_existing_files(client, objects, uploaded=None)
+    with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        pending = set()
+        try:
+            for i, obj in enumerate(objects):
+                if len(pending) >= 2 * max_concurrent:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                pending.add(executor.submit(_upload_file, client, obj, i, overwrite, ignore_meta))
+            for future in as_completed(pending):
+                future.result()
+        except KeyboardInterrupt:
+            for future in pending:  # Don't start queued uploads, only wait for those already running
+                future.cancel()
+            raise
 
 
 def process_path(
-    client: CogniteClient,
+    client: "CogniteClient",
     root_path: Path,
     pattern: str = "*",
     recursive: bool = True,
@@ -172,21 +392,32 @@ def process_path(
     ignore_meta: bool = False,
     raw_db: str = None,
     raw_table: str = None,
+    max_concurrent: int = 16,
 ) -> None:
     """Find files in 'root_path' and upload them to CDF."""
+    root_path = root_path.resolve()
     file_paths = match_files(root_path, pattern, recursive=recursive)
     file_objects = convert_to_file_objects(root_path, file_paths)
 
     if ignore_existing:
         file_objects = filter_away_existing_files(client, file_objects)
+    if upload_to_raw and upload_to_cdf:
+        file_objects = list(file_objects)  # Consumed twice
 
     if upload_to_raw:
         upload_metadata_to_raw(client, file_objects, raw_db, raw_table)
     if upload_to_cdf:
-        upload_files_to_cdf(client, file_objects, overwrite, ignore_meta)
+        upload_files_to_cdf(
+            client, file_objects, overwrite, ignore_meta, max_concurrent, skip_existing=not ignore_existing
+        )
+    if not upload_to_raw and not upload_to_cdf:
+        collections.deque(file_objects, maxlen=0)  # Dry run, still scan the files to log how many were found
 
 
 def main(args):
+    from cognite.client import CogniteClient
+    from cognite.client.exceptions import CogniteAPIError
+
     _configure_logger(args.log, args.log_level)
 
     api_key = args.api_key if args.api_key else os.environ.get("COGNITE_EXTRACTOR_API_KEY")
@@ -198,11 +429,12 @@ def main(args):
         sys.exit(2)
 
     try:
-        client = CogniteClient(api_key=api_key, client_name=COGNITE_CLIENT_NAME)
+        client = CogniteClient(api_key=api_key, client_name=COGNITE_CLIENT_NAME, max_workers=args.max_concurrent)
         logger.info(client.login.status())
     except CogniteAPIError as exc:
         logger.error("Failed to create CDF client: {!s}".format(exc))
-        client = CogniteClient(api_key=api_key, client_name=COGNITE_CLIENT_NAME)
+        client = CogniteClient(api_key=api_key, client_name=COGNITE_CLIENT_NAME, max_workers=args.max_concurrent)
+    _configure_http_sessions(client, args.max_concurrent)
 
     try:
         process_path(
@@ -217,6 +449,7 @@ def main(args):
             args.ignore_meta,
             args.raw_db,
             args.raw_table,
+            args.max_concurrent,
         )
     except KeyboardInterrupt:
         logger.warning("Extractor stopped")